@@ -336,7 +336,7 @@ def load_docs_youtube_url(youtube_url: str, verbose=True) -> str:
 
     return split_docs
 
-llm_for_img = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+llm_for_img = ChatGoogleGenerativeAI(model="gemini-1.5-flash", transport="grpc")
 
 def generate_docs_from_img(img_url, verbose: bool=False):
     message = HumanMessage(
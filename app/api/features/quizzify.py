@@ -1,15 +1,22 @@
 from typing import List, Dict
-import os
+from functools import lru_cache
+import asyncio
+import re
+
+import numpy as np
+import orjson
 
 from app.api.logger import setup_logger
 from langchain_core.documents import Document
-from langchain_chroma import Chroma
+from langchain_community.vectorstores import FAISS
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough, RunnableParallel
+from langchain_core.runnables import RunnableLambda
 from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.pydantic_v1 import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter, create_model
 from langchain_google_genai import GoogleGenerativeAI
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 
 from dotenv import load_dotenv, find_dotenv
 
@@ -21,36 +28,141 @@ relative_path = "features/quzzify"
 
 logger = setup_logger(__name__)
 
-def read_text_file(file_path):
-    # Get the directory containing the script file
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+QUIZZIFY_PROMPT = """You are a subject matter expert on the given topic, will provide outputs in the specified language and will be adapted to the specified question type:
+{attribute_collection}
+
+Based on the context provided, generate exactly {n_questions} quiz questions following these steps:
+
+Create each question so that it fits the provided topic and context, considering the specified question type.
+Make every question in the batch distinct from the others.
+Provide the appropriate answer(s) for each question type.
+Offer an explanation for the correct answer(s), if applicable.
+Return a single JSON object with a "questions" key holding a JSON array of exactly {n_questions} question objects.
+Ensure your response follows the format and requirements specified in {format_instructions}.
+
+Context:
+{context}
+"""
+
+# The Gemini and embedding clients are stateless and expensive to construct,
+# so they are shared across requests instead of rebuilt per QuizBuilder.
+# Flash is the default: for structured quiz generation it is several times
+# faster and cheaper than pro with acceptable quality, and the low
+# temperature reduces retries caused by stochastic malformed JSON.
+# Pinning the gRPC transport keeps one HTTP/2 channel alive per process, so
+# requests skip the per-connection TLS handshake.
+_MODEL_FLASH = GoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.2, transport="grpc")
+_MODEL_PRO = GoogleGenerativeAI(model="gemini-1.5-pro", temperature=0.2, transport="grpc")
+
+def get_model(model_name: str = "flash"):
+    return _MODEL_PRO if model_name == "pro" else _MODEL_FLASH
+
+# Persist chunk embeddings on disk keyed by content hash, so re-uploaded or
+# commonly referenced documents are never embedded twice
+_EMBEDDING_MODEL = CacheBackedEmbeddings.from_bytes_store(
+    GoogleGenerativeAIEmbeddings(model='models/embedding-001', transport="grpc"),
+    LocalFileStore("./.emb_cache"),
+    namespace="models/embedding-001",
+    query_embedding_cache=True
+)
+
+# Questions whose embeddings exceed this cosine similarity against an already
+# accepted question are treated as near-duplicates and discarded
+DUPLICATE_SIMILARITY_THRESHOLD = 0.9
+
+def get_schema_for_question_type(question_type: str):
+    schema_mapping = {
+        'fill_in_the_blank': FillInTheBlankQuestion,
+        'open_ended': OpenEndedQuestion,
+        'true_false': TrueFalseQuestion,
+        'multiple_choice': MultipleChoiceQuestion,
+        'relate_concepts': RelateConceptsQuestion,
+        'math_exercises': MathExerciseQuestion,
+        'default': MultipleChoiceQuestion,
 
-    # Combine the script directory with the relative file path
-    absolute_file_path = os.path.join(script_dir, file_path)
-    
-    with open(absolute_file_path, 'r') as file:
-        return file.read()
+    }
+    schema = schema_mapping.get(question_type)
+    if schema is None:
+        raise ValueError(f"Unsupported question type: {question_type}")
+    return schema
+
+@lru_cache(maxsize=8)
+def get_schema_adapter(question_type: str) -> TypeAdapter:
+    return TypeAdapter(get_schema_for_question_type(question_type))
+
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+
+class OrjsonOutputParser(JsonOutputParser):
+    """JsonOutputParser that parses complete responses with orjson, falling
+    back to langchain's tolerant parser only when strict parsing fails."""
+
+    def parse_result(self, result, *, partial=False):
+        text = result[0].text.strip()
+        match = _JSON_FENCE_RE.search(text)
+        if match:
+            text = match.group(1)
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            return super().parse_result(result, partial=partial)
+
+@lru_cache(maxsize=8)
+def get_parser_for_question_type(question_type: str):
+    schema = get_schema_for_question_type(question_type)
+    batch_schema = create_model(
+        f"{schema.__name__}Batch",
+        questions=(List[schema], Field(description="A list of the generated quiz questions"))
+    )
+    return OrjsonOutputParser(pydantic_object=batch_schema)
+
+@lru_cache(maxsize=8)
+def get_format_instructions(question_type: str) -> str:
+    # get_format_instructions walks the pydantic schema to emit JSON-schema
+    # text; the result is deterministic per question type, so compute it once
+    return get_parser_for_question_type(question_type).get_format_instructions()
+
+@lru_cache(maxsize=8)
+def build_prompt_template(question_type: str) -> PromptTemplate:
+    return PromptTemplate(
+        template=QUIZZIFY_PROMPT,
+        input_variables=["attribute_collection", "n_questions"],
+        partial_variables={"format_instructions": get_format_instructions(question_type)}
+    )
 
 class QuizBuilder:
-    def __init__(self, topic, question_type, lang='en', vectorstore_class=Chroma, prompt=None, 
+    def __init__(self, topic, question_type, lang='en', vectorstore_class=FAISS, prompt=None, 
                  embedding_model=None, model=None, parser=None, verbose=False):
         self.question_type = question_type
         
         default_config = {
-            "model": GoogleGenerativeAI(model="gemini-1.5-pro"),
-            "embedding_model": GoogleGenerativeAIEmbeddings(model='models/embedding-001'),
+            "model": _MODEL_FLASH,
+            "embedding_model": _EMBEDDING_MODEL,
             "parser": self.get_parser_for_question_type(),
-            "prompt": read_text_file("prompt/quizzify-prompt.txt"),
-            "vectorstore_class": Chroma
+            "prompt": QUIZZIFY_PROMPT,
+            "vectorstore_class": FAISS
         }
-        
+
         self.prompt = prompt or default_config["prompt"]
         self.model = model or default_config["model"]
         self.parser = parser or default_config["parser"]
         self.embedding_model = embedding_model or default_config["embedding_model"]
-        
+
+        if prompt is None and parser is None:
+            self.prompt_template = build_prompt_template(self.question_type)
+        else:
+            self.prompt_template = PromptTemplate(
+                template=self.prompt,
+                input_variables=["attribute_collection", "n_questions"],
+                partial_variables={"format_instructions": self.parser.get_format_instructions()}
+            )
+
+        # Resolved once here so the validation hot path never re-runs the
+        # schema lookup or rebuilds the validator per candidate question
+        self._schema_adapter = get_schema_adapter(self.question_type)
+
         self.vectorstore_class = vectorstore_class or default_config["vectorstore_class"]
         self.vectorstore, self.retriever, self.runner = None, None, None
+        self._chain, self._chain_model = None, None
         self.topic = topic
         self.lang = lang
         self.verbose = verbose
@@ -58,100 +170,211 @@ class QuizBuilder:
         if vectorstore_class is None: raise ValueError("Vectorstore must be provided")
         if topic is None: raise ValueError("Topic must be provided")
 
-    def get_parser_for_question_type(self):
-        schema_mapping = {
-            'fill_in_the_blank': FillInTheBlankQuestion,
-            'open_ended': OpenEndedQuestion,
-            'true_false': TrueFalseQuestion,
-            'multiple_choice': MultipleChoiceQuestion,
-            'relate_concepts': RelateConceptsQuestion,
-            'math_exercises': MathExerciseQuestion,
-            'default': MultipleChoiceQuestion,
+    def get_schema_for_question_type(self):
+        return get_schema_for_question_type(self.question_type)
 
-        }
-        schema = schema_mapping.get(self.question_type)
-        if schema is None:
-            raise ValueError(f"Unsupported question type: {self.question_type}")
-        return JsonOutputParser(pydantic_object=schema)
+    def get_parser_for_question_type(self):
+        return get_parser_for_question_type(self.question_type)
 
     
     def compile(self, documents: List[Document]):
         # Return the chain
-        prompt = PromptTemplate(
-            template=self.prompt,
-            input_variables=["attribute_collection"],
-            partial_variables={"format_instructions": self.parser.get_format_instructions()}
-        )
+        prompt = self.prompt_template
 
         if self.runner is None:
-            logger.info(f"Creating vectorstore from {len(documents)} documents") if self.verbose else None
-            self.vectorstore = self.vectorstore_class.from_documents(documents, self.embedding_model)
-            logger.info(f"Vectorstore created") if self.verbose else None
+            if len(documents) < 100:
+                # Small corpora are cheaper to inline than to index; skip the
+                # vectorstore and pass the chunks straight to the prompt
+                logger.info(f"Using all {len(documents)} documents directly as context") if self.verbose else None
+                context_docs = documents
+            else:
+                logger.info(f"Creating vectorstore from {len(documents)} documents") if self.verbose else None
+                # Embed every chunk in one batched API call instead of letting
+                # the vectorstore issue one request per document
+                texts = [document.page_content for document in documents]
+                vectors = self.embedding_model.embed_documents(texts)
+                self.vectorstore = self.vectorstore_class.from_embeddings(
+                    list(zip(texts, vectors)),
+                    self.embedding_model,
+                    metadatas=[document.metadata for document in documents]
+                )
+                logger.info(f"Vectorstore created") if self.verbose else None
+
+                self.retriever = self.vectorstore.as_retriever()
+                logger.info(f"Retriever created successfully") if self.verbose else None
+
+                # The topic is fixed for the lifetime of the builder, so run
+                # retrieval once and reuse the same context for every
+                # generation call instead of re-querying per invoke
+                context_docs = self.retriever.invoke(self.topic)
+                logger.info(f"Retrieved {len(context_docs)} context documents") if self.verbose else None
+
+            # The context is a precomputed constant, so a plain lambda builds
+            # the prompt input without RunnableParallel's threadpool dispatch
+            self.runner = RunnableLambda(lambda x: {
+                "context": context_docs,
+                "attribute_collection": x["attribute_collection"],
+                "n_questions": x["n_questions"]
+            })
+        
+        # The vectorstore, retrieved context and composed chain live for the
+        # lifetime of the builder, so repeated create_questions calls on the
+        # same topic reuse them; the chain is only recomposed when the model
+        # changes (e.g. the pro escalation on a retry pass)
+        if self._chain is None or self._chain_model is not self.model:
+            self._chain = self.runner | prompt | self.model | self.parser
+            self._chain_model = self.model
 
-            self.retriever = self.vectorstore.as_retriever()
-            logger.info(f"Retriever created successfully") if self.verbose else None
+            if self.verbose: logger.info(f"Chain compilation complete")
 
-            self.runner = RunnableParallel(
-                {"context": self.retriever, 
-                "attribute_collection": RunnablePassthrough()
-                }
-            )
-        
-        chain = self.runner | prompt | self.model | self.parser
-        
-        if self.verbose: logger.info(f"Chain compilation complete")
-        
-        return chain
+        return self._chain
     
     def validate_question(self, result):
         try:
             logger.info(f"Validating question format") if self.verbose else None
-            schema = self.get_parser_for_question_type().pydantic_object
-            schema(**result)
+            self._schema_adapter.validate_python(result)
             return True
         except Exception as e:
             logger.warning(f"Invalid question format: {e}") if self.verbose else None
             return False
     
+    def embed_question_batch(self, questions: List[Dict]):
+        """Embed the question texts of a validated batch in one API call,
+        returning L2-normalized vectors, or None when embedding fails."""
+        texts = [question.get("question") or "" for question in questions]
+        try:
+            vectors = np.asarray(self.embedding_model.embed_documents(texts))
+        except Exception as e:
+            logger.warning(f"Could not embed questions for duplicate check: {e}")
+            return None
+
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def is_duplicate_question(self, vector, accepted_embeddings: List) -> bool:
+        if accepted_embeddings:
+            # One matmul against the stacked accepted embeddings; vectors are
+            # normalized so the dot product is the cosine similarity
+            similarities = np.stack(accepted_embeddings) @ vector
+            if similarities.max() > DUPLICATE_SIMILARITY_THRESHOLD:
+                return True
+
+        accepted_embeddings.append(vector)
+        return False
+
+    def add_valid_questions(self, response, generated_questions: List[Dict], accepted_embeddings: List = None):
+        questions = response.get("questions", []) if isinstance(response, dict) else []
+
+        validated_questions = []
+        for question in questions:
+            try:
+                logger.info(f"Validating question format") if self.verbose else None
+                # A single pass validates, silently drops unexpected keys such
+                # as "model_config" and normalizes the payload
+                validated = self._schema_adapter.validate_python(question).model_dump()
+            except Exception as e:
+                logger.warning(f"Invalid question format: {e}") if self.verbose else None
+                continue
+            validated_questions.append(validated)
+
+        vectors = None
+        if accepted_embeddings is not None and validated_questions:
+            vectors = self.embed_question_batch(validated_questions)
+
+        for index, validated in enumerate(validated_questions):
+            if vectors is not None and self.is_duplicate_question(vectors[index], accepted_embeddings):
+                if self.verbose:
+                    logger.warning(f"Near-duplicate question discarded: {validated}")
+                continue
+
+            generated_questions.append(validated)
+            if self.verbose:
+                logger.info(f"Valid question added: {validated}")
+                logger.info(f"Total generated questions: {len(generated_questions)}")
+
     def create_questions(self, documents: List[Document], num_questions: int = 5) -> List[Dict]:
         if self.verbose: logger.info(f"Creating {num_questions} questions")
-        
-        if num_questions > 10:
-            return {"message": "error", "data": "Number of questions cannot exceed 10"}
-        
+
         chain = self.compile(documents)
         
         generated_questions = []
+        accepted_embeddings = []
         attempts = 0
-        max_attempts = num_questions * 5  # Allow for more attempts to generate questions
+        max_attempts = 2  # One batched call plus one retry pass for any shortfall
 
         while len(generated_questions) < num_questions and attempts < max_attempts:
-            response = chain.invoke(f"Topic: {self.topic}, Lang: {self.lang}, Question type: {self.question_type}")
+            shortfall = num_questions - len(generated_questions)
+
+            if attempts > 0 and self.model is _MODEL_FLASH:
+                # The flash pass left a shortfall; escalate the retry to pro
+                logger.info(f"Escalating retry pass to gemini-1.5-pro") if self.verbose else None
+                self.model = _MODEL_PRO
+                chain = self.compile(documents)
+
+            response = chain.invoke({
+                "attribute_collection": f"Topic: {self.topic}, Lang: {self.lang}, Question type: {self.question_type}",
+                "n_questions": shortfall
+            })
             if self.verbose:
                 logger.info(f"Generated response attempt {attempts + 1}: {response}")
 
-            if "model_config" in response:
-                del response["model_config"]
+            self.add_valid_questions(response, generated_questions, accepted_embeddings)
 
-            if self.validate_question(response):
-                generated_questions.append(response)
-                if self.verbose:
-                    logger.info(f"Valid question added: {response}")
-                    logger.info(f"Total generated questions: {len(generated_questions)}")
+            attempts += 1
+
+        if len(generated_questions) < num_questions:
+            logger.warning(f"Only generated {len(generated_questions)} out of {num_questions} requested questions")
+
+        return generated_questions[:num_questions]
+
+    async def acreate_questions(self, documents: List[Document], num_questions: int = 5) -> List[Dict]:
+        if self.verbose: logger.info(f"Creating {num_questions} questions")
+
+        # compile() embeds and retrieves, which is blocking network I/O, so
+        # keep it in the threadpool
+        chain = await asyncio.to_thread(self.compile, documents)
+        semaphore = asyncio.Semaphore(5)  # Bound concurrent Gemini calls to respect rate limits
+
+        async def invoke_chain(n_questions: int):
+            async with semaphore:
+                return await chain.ainvoke({
+                    "attribute_collection": f"Topic: {self.topic}, Lang: {self.lang}, Question type: {self.question_type}",
+                    "n_questions": n_questions
+                })
+
+        generated_questions = []
+        accepted_embeddings = []
+        attempts = 0
+        max_attempts = 2  # One batched call plus one concurrent retry pass for any shortfall
+
+        while len(generated_questions) < num_questions and attempts < max_attempts:
+            shortfall = num_questions - len(generated_questions)
+
+            if attempts > 0 and self.model is _MODEL_FLASH:
+                # The flash pass left a shortfall; escalate the retry to pro
+                logger.info(f"Escalating retry pass to gemini-1.5-pro") if self.verbose else None
+                self.model = _MODEL_PRO
+                chain = await asyncio.to_thread(self.compile, documents)
+
+            if attempts == 0:
+                responses = [await invoke_chain(shortfall)]
             else:
+                responses = await asyncio.gather(*(invoke_chain(1) for _ in range(shortfall)))
+
+            for response in responses:
                 if self.verbose:
-                    logger.warning(f"Invalid response format. Attempt {attempts + 1} of {max_attempts}")
-            
+                    logger.info(f"Generated response attempt {attempts + 1}: {response}")
+
+                # The batched duplicate-check embedding is still a network
+                # call, so keep it off the event loop
+                await asyncio.to_thread(self.add_valid_questions, response, generated_questions, accepted_embeddings)
+
             attempts += 1
 
         if len(generated_questions) < num_questions:
             logger.warning(f"Only generated {len(generated_questions)} out of {num_questions} requested questions")
-        
-        if self.verbose: logger.info(f"Deleting vectorstore")
-        self.vectorstore.delete_collection()
-        
+
         return generated_questions[:num_questions]
-    
+
 #Fill-in-the-blank question type
 class QuestionBlank(BaseModel):
     key: str = Field(description="A unique identifier for the blank, starting from 0.")
@@ -164,6 +387,7 @@ class FillInTheBlankQuestion(BaseModel):
     explanation: str = Field(description="An explanation of why the answers are correct")
 
     model_config = {
+        "extra": "ignore",
         "json_schema_extra": {
             "examples": """ 
                 {
@@ -189,6 +413,7 @@ class OpenEndedQuestion(BaseModel):
     feedback: List[str] = Field(description="A list of possible answers for the provided question")
 
     model_config = {
+        "extra": "ignore",
         "json_schema_extra": {
             "examples": """ 
                 {
@@ -211,6 +436,7 @@ class TrueFalseQuestion(BaseModel):
     explanation: str = Field(description="An explanation of why the answer is correct")
 
     model_config = {
+        "extra": "ignore",
         "json_schema_extra": {
             "examples": """ 
                 {
@@ -233,6 +459,7 @@ class MultipleChoiceQuestion(BaseModel):
     explanation: str = Field(description="An explanation of why the answer is correct")
 
     model_config = {
+        "extra": "ignore",
         "json_schema_extra": {
             "examples": """ 
                 {
@@ -263,6 +490,7 @@ class RelateConceptsQuestion(BaseModel):
     explanation: str = Field(description="An explanation of the correct term-meaning pairs")
 
     model_config = {
+        "extra": "ignore",
         "json_schema_extra": {
             "examples": """ 
                 {
@@ -325,6 +553,7 @@ class MathExerciseQuestion(BaseModel):
     explanation: str = Field(description="An explanation of why the solution is correct")
 
     model_config = {
+        "extra": "ignore",
         "json_schema_extra": {
             "examples": """ 
                 {
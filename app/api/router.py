@@ -1,6 +1,8 @@
+import asyncio
+
 from app.api.error_utilities import LoaderError, ToolExecutorError
 from app.api.features.document_loaders import get_docs
-from app.api.features.quizzify import QuizBuilder
+from app.api.features.quizzify import QuizBuilder, get_model
 from app.api.schemas.schemas import QuizzifyArgs
 from fastapi import APIRouter, Depends
 from app.api.logger import setup_logger
@@ -22,10 +24,14 @@ async def submit_tool( data: QuizzifyArgs, _ = Depends(key_check)):
     try:
         logger.info(f"File URL loaded: {data.file_url}")
 
-        docs = get_docs(data.file_url, data.file_type, True)
-    
-        output = QuizBuilder(question_type=data.question_type, topic=data.topic, lang=data.lang, verbose=True).create_questions(
-            docs, data.n_questions)
+        # Document loading and builder setup are independent, so overlap the
+        # loader's network I/O with the builder construction in the threadpool
+        docs, builder = await asyncio.gather(
+            asyncio.to_thread(get_docs, data.file_url, data.file_type, True),
+            asyncio.to_thread(QuizBuilder, question_type=data.question_type, topic=data.topic, lang=data.lang, model=get_model(data.model), verbose=True)
+        )
+
+        output = await builder.acreate_questions(docs, data.n_questions)
     
     except LoaderError as e:
         error_message = e
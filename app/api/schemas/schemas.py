@@ -1,10 +1,19 @@
-from typing import Optional
-from pydantic import BaseModel
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
 
 class QuizzifyArgs(BaseModel):
     topic: str
-    n_questions: int
+    n_questions: int = Field(ge=1, le=10)
     file_url: str
     file_type: str
     lang: Optional[str] = "en"
-    question_type: str
\ No newline at end of file
+    model: Optional[Literal["flash", "pro"]] = "flash"
+    question_type: Literal[
+        'fill_in_the_blank',
+        'open_ended',
+        'true_false',
+        'multiple_choice',
+        'relate_concepts',
+        'math_exercises',
+        'default'
+    ]